@@ -1252,7 +1252,7 @@ class DefaultOSUtil(object):
             for vmbus, guid in DefaultOSUtil._enumerate_device_id():
                 if guid.startswith(gen1_device_prefix) or guid == gen2_device_id:
                     for root, dirs, files in os.walk(STORAGE_DEVICE_PATH + vmbus):  # pylint: disable=W0612
-                        root_path_parts = root.split('/')
+                        root_path_parts = root.rsplit('/', 2)
                         # For Gen1 VMs we only have to check for the block dir in the
                         # current device. But for Gen2 VMs all of the disks (sda, sdb,
                         # sr0) are presented in this device on the same SCSI controller.
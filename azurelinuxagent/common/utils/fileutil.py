@@ -103,7 +103,8 @@ def mkdir(dirpath, mode=None, owner=None):
     if not os.path.isdir(dirpath):
         os.makedirs(dirpath)
     if mode is not None:
-        chmod(dirpath, mode)
+        # the directory is known to exist at this point, no need to go through chmod()
+        os.chmod(dirpath, mode)
     if owner is not None:
         chowner(dirpath, owner)
 
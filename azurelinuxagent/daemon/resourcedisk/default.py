@@ -15,12 +15,17 @@
 # Requires Python 2.6+ and Openssl 1.0+
 #
 
+import ctypes
+import errno
+import json
 import os
+import platform
 import re
+import select
 import stat
 import sys
 import threading
-from time import sleep
+import time
 
 import azurelinuxagent.common.logger as logger
 from azurelinuxagent.common.future import ustr
@@ -30,6 +35,7 @@ import azurelinuxagent.common.utils.fileutil as fileutil
 import azurelinuxagent.common.utils.shellutil as shellutil
 from azurelinuxagent.common.exception import ResourceDiskError
 from azurelinuxagent.common.osutil import get_osutil
+from azurelinuxagent.common.utils.shellutil import CommandError
 from azurelinuxagent.common.version import AGENT_NAME
 
 DATALOSS_WARNING_FILE_NAME = "DATALOSS_WARNING_README.txt"
@@ -44,29 +50,74 @@ For additional details to please refer to the MSDN documentation at :
 http://msdn.microsoft.com/en-us/library/windowsazure/jj672979.aspx
 """
 
+PARTITION_WAIT_TIMEOUT = 30
+_PREALLOCATED_SWAP_MIN_KERNEL = (4, 18)
+_PARTED_PARTITION_LINE_RE = re.compile(r"^\s*\d+")
+_STAGE_MARKER = "::STAGE::"
+_MOUNTINFO_PATH = "/proc/self/mountinfo"
+_SWAPS_PATH = "/proc/swaps"
+_MOUNT_COMMAND = "mount -t {0} {1} {2}"
+_MOUNT_COMMAND_WITH_OPTIONS = "mount -t {0} -o {1} {2} {3}"
+
+# the wall clock can be stepped during boot (e.g. by time sync); use a
+# monotonic clock where available (Python 3.3+)
+_monotonic = getattr(time, "monotonic", time.time)
+
+# inotify(7) constants
+_IN_CLOEXEC = 0o2000000
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
 
 class ResourceDiskHandler(object):
     def __init__(self):
         self.osutil = get_osutil()
         self.fs = conf.get_resourcedisk_filesystem()
+        self._format_enabled = conf.get_resourcedisk_format()
+        self._mount_point = conf.get_resourcedisk_mountpoint()
+        self._mount_options = conf.get_resourcedisk_mountoptions()
+        self._swap_enabled = conf.get_resourcedisk_enable_swap()
+        self._swap_size_mb = conf.get_resourcedisk_swap_size_mb()
+        # concurrent invocations of mount(8) race with each other
+        self._mount_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._claimed_mounts = set()
 
     def start_activate_resource_disk(self):
+        # only one thread should partition and mount the disk; repeated calls are no-ops
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
         disk_thread = threading.Thread(target=self.run)
+        disk_thread.setDaemon(True)
         disk_thread.start()
 
     def run(self):
-        mount_point = None
-        if conf.get_resourcedisk_format():
-            mount_point = self.activate_resource_disk()
-        if mount_point is not None and \
-                conf.get_resourcedisk_enable_swap():
+        if not self._format_enabled:
+            return
+        mount_point = self.activate_resource_disk()
+        if mount_point is not None and self._swap_enabled:
             self.enable_swap(mount_point)
 
     def activate_resource_disk(self):
         logger.info("Activate resource disk")
+        # do not let concurrent activations partition and mount at the same mount point
+        with self._start_lock:
+            if self._mount_point in self._claimed_mounts:
+                logger.warn("Skipping duplicate activation of mount point {0}", self._mount_point)
+                return None
+            self._claimed_mounts.add(self._mount_point)
         try:
-            mount_point = conf.get_resourcedisk_mountpoint()
-            mount_point = self.mount_resource_disk(mount_point)
+            return self._activate_resource_disk()
+        finally:
+            with self._start_lock:
+                self._claimed_mounts.discard(self._mount_point)
+
+    def _activate_resource_disk(self):
+        try:
+            mount_point = self.mount_resource_disk(self._mount_point)
             warning_file = os.path.join(mount_point,
                                         DATALOSS_WARNING_FILE_NAME)
             try:
@@ -83,15 +134,143 @@ class ResourceDiskHandler(object):
     def enable_swap(self, mount_point):
         logger.info("Enable swap")
         try:
-            size_mb = conf.get_resourcedisk_swap_size_mb()
-            self.create_swap_space(mount_point, size_mb)
+            self.create_swap_space(mount_point, self._swap_size_mb)
         except ResourceDiskError as e:
             logger.error("Failed to enable swap {0}", e)
 
+    @staticmethod
+    def _try_run_command(command, log_error=False):
+        """
+        Runs 'command' (a list of arguments, no shell involved) and returns
+        True if it succeeded, False otherwise.
+        """
+        try:
+            shellutil.run_command(command, log_error=log_error)
+            return True
+        except (CommandError, OSError) as e:
+            logger.info("Command {0} failed: {1}", command, ustr(e))
+            return False
+
+    def _mount(self, mount_command, log_error=False):
+        """
+        Runs 'mount_command' (a list of arguments) under the mount lock.
+        Raises CommandError if mount fails, including when it cannot be run.
+        """
+        with self._mount_lock:
+            try:
+                shellutil.run_command(mount_command, log_error=log_error)
+            except OSError as e:
+                raise CommandError(command=mount_command, return_code=-1, stdout="", stderr=ustr(e))
+
+    @staticmethod
+    def _get_reread_partition_table_commands(device):
+        """
+        Returns the commands that force a re-read of the partition table of
+        'device' and then wait for udev to drain its event queue, so that
+        the partition nodes are up to date. Both are best effort.
+        """
+        return [
+            ["blockdev", "--rereadpt", device],
+            ["udevadm", "settle", "--timeout={0}".format(PARTITION_WAIT_TIMEOUT)]
+        ]
+
     def reread_partition_table(self, device):
-        if shellutil.run("sfdisk -R {0}".format(device), chk_err=False):
-            shellutil.run("blockdev --rereadpt {0}".format(device),
-                          chk_err=False)
+        for command in self._get_reread_partition_table_commands(device):
+            self._try_run_command(command)
+
+    def get_existing_mount_point(self, device):
+        """
+        Returns the mount point of 'device' (or of any of its partitions) if
+        it is mounted, None otherwise. Reads /proc/self/mountinfo, falling
+        back to the output of mount(8) if that is not available.
+        """
+        try:
+            mountinfo = fileutil.read_file(_MOUNTINFO_PATH)
+        except (IOError, OSError) as e:
+            logger.info("Could not read {0}: {1}", _MOUNTINFO_PATH, ustr(e))
+            mount_list = shellutil.run_get_output("mount")[1]
+            return self.osutil.get_mount_point(mount_list, device)
+
+        # Example of mountinfo (see proc(5)):
+        #   36 35 98:0 / /mnt/resource rw,relatime shared:1 - ext4 /dev/sdb1 rw
+        # the mount point is the 5th field, and the mount source follows the
+        # filesystem type after the '-' separator
+        for line in mountinfo.splitlines():
+            fields = line.split()
+            if "-" not in fields:
+                continue
+            separator = fields.index("-")
+            if len(fields) > separator + 2 and fields[separator + 2].startswith(device):
+                return fields[4]
+        return None
+
+    @staticmethod
+    def _run_stages(stages):
+        """
+        Runs the (name, command) pairs in 'stages' as a single shell command,
+        stopping at the first one that fails. Returns the exit code, the
+        combined output, and the name of the last stage that was started.
+        """
+        command = " && ".join(["echo {0}{1} && {2}".format(_STAGE_MARKER, name, cmd) for name, cmd in stages])
+        ret, output = shellutil.run_get_output(command, chk_err=False)
+        stage = None
+        for line in output.splitlines():
+            if line.startswith(_STAGE_MARKER):
+                stage = line[len(_STAGE_MARKER):].strip()
+        return ret, output, stage
+
+    @staticmethod
+    def _inotify_watch(directory):
+        """
+        Returns an inotify file descriptor watching 'directory' for new
+        entries, or None if inotify is not available.
+        """
+        try:
+            # resolve the symbols from the libc already loaded in the process;
+            # ctypes.util.find_library() would spawn ldconfig/gcc
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(_IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.info("inotify is not available: {0}", e)
+            return None
+        if fd < 0:
+            logger.info("inotify_init1 failed: {0}", os.strerror(ctypes.get_errno()))
+            return None
+        path = directory.encode("utf-8") if isinstance(directory, ustr) else directory
+        if libc.inotify_add_watch(fd, path, _IN_CREATE | _IN_MOVED_TO) < 0:
+            logger.info("inotify_add_watch on {0} failed: {1}", directory, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return fd
+
+    def _wait_for_partition(self, partition, timeout=PARTITION_WAIT_TIMEOUT):
+        """
+        Waits up to 'timeout' seconds for the device node of 'partition' to
+        show up. The watch on the parent directory is armed before checking
+        for the node, so a node created in between cannot be missed. Falls
+        back to polling if inotify is not available.
+        """
+        if os.path.exists(partition):
+            return True
+
+        deadline = _monotonic() + timeout
+        fd = self._inotify_watch(os.path.dirname(partition))
+        try:
+            logger.info("Waiting for partition [{0}], timeout {1}s", partition, timeout)
+            while not os.path.exists(partition):
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return False
+                if fd is None:
+                    time.sleep(min(remaining, 1))
+                    continue
+                if select.select([fd], [], [], remaining)[0]:
+                    # drain the pending events; the loop condition re-checks the node
+                    os.read(fd, 4096)
+            return True
+        finally:
+            if fd is not None:
+                os.close(fd)
 
     def mount_resource_disk(self, mount_point):
         device = self.osutil.device_for_ide_port(1)
@@ -100,8 +279,7 @@ class ResourceDiskHandler(object):
 
         device = "/dev/{0}".format(device)
         partition = device + "1"
-        mount_list = shellutil.run_get_output("mount")[1]
-        existing = self.osutil.get_mount_point(mount_list, device)
+        existing = self.get_existing_mount_point(device)
 
         if existing:
             logger.info("Resource disk [{0}] is already mounted [{1}]",
@@ -118,98 +296,71 @@ class ResourceDiskHandler(object):
             raise ResourceDiskError(msg=msg, inner=ose)
 
         logger.info("Examining partition table")
-        ret = shellutil.run_get_output("parted {0} print".format(device))
-        if ret[0]:
-            raise ResourceDiskError("Could not determine partition info for "
-                                    "{0}: {1}".format(device, ret[1]))
+        is_gpt, partition_count = self.get_partition_table_info(device)
 
         force_option = 'F'
         if self.fs == 'xfs':
             force_option = 'f'
-        mkfs_string = "mkfs.{0} -{2} {1}".format(
-            self.fs, partition, force_option)
-
-        if "gpt" in ret[1]:
-            logger.info("GPT detected, finding partitions")
-            parts = [x for x in ret[1].split("\n") if
-                     re.match(r"^\s*[0-9]+", x)]
-            logger.info("Found {0} GPT partition(s).", len(parts))
-            if len(parts) > 1:
-                logger.info("Removing old GPT partitions")
-                for i in range(1, len(parts) + 1):
-                    logger.info("Remove partition {0}", i)
-                    shellutil.run("parted {0} rm {1}".format(device, i))
-
-                logger.info("Creating new GPT partition")
-                shellutil.run(
-                    "parted {0} mkpart primary 0% 100%".format(device))
-
-                logger.info("Format partition [{0}]", mkfs_string)
-                shellutil.run(mkfs_string)
+        mkfs_command = ["mkfs.{0}".format(self.fs), "-{0}".format(force_option), partition]
+        # the joined form is only run as a stage of the GPT re-partitioning chain
+        mkfs_string = " ".join(mkfs_command)
+        mount_command = self.get_mount_command(self._mount_options,
+                                               partition,
+                                               mount_point)
+
+        if is_gpt:
+            logger.info("GPT detected, found {0} GPT partition(s).", partition_count)
+            if partition_count > 1:
+                logger.info("Removing old GPT partitions, creating and formatting a new one [{0}]", mkfs_string)
+                remove_parts = " ".join(["rm {0}".format(i) for i in range(1, partition_count + 1)])
+                # as in reread_partition_table(), failures of the re-read are not fatal
+                reread = "{{ {0}; }} || true".format(
+                    "; ".join([" ".join(command) for command in self._get_reread_partition_table_commands(device)]))
+                ret, output, stage = self._run_stages([
+                    ("parted", "parted -s {0} {1} mkpart primary 0% 100%".format(device, remove_parts)),
+                    ("reread", reread),
+                    ("mkfs", mkfs_string)])
+                if ret:
+                    logger.warn("Failed to recreate GPT partition at stage [{0}]: [{1}] {2}", stage, ret, output)
+                    if stage == "parted":
+                        # parted exits with an error when it cannot inform the kernel of the
+                        # new table (e.g. on a busy disk), although the table was written;
+                        # re-read it and format the partition anyway, as the chain would have
+                        logger.info("Re-reading the partition table and formatting partition [{0}]", mkfs_string)
+                        self.reread_partition_table(device)
+                        self._try_run_command(mkfs_command, log_error=True)
+                    # if mkfs failed, the mount below fails and its retry formats the partition again
         else:
             logger.info("GPT not detected, determining filesystem")
             ret = self.change_partition_type(
                 suppress_message=True,
-                option_str="{0} 1 -n".format(device))
+                options=[device, "1", "-n"])
             ptype = ret[1].strip()
             if ptype == "7" and self.fs != "ntfs":
                 logger.info("The partition is formatted with ntfs, updating "
                             "partition type to 83")
                 self.change_partition_type(
                     suppress_message=False,
-                    option_str="{0} 1 83".format(device))
+                    options=[device, "1", "83"])
                 self.reread_partition_table(device)
                 logger.info("Format partition [{0}]", mkfs_string)
-                shellutil.run(mkfs_string)
+                self._try_run_command(mkfs_command, log_error=True)
             else:
                 logger.info("The partition type is {0}", ptype)
 
-        mount_options = conf.get_resourcedisk_mountoptions()
-        mount_string = self.get_mount_string(mount_options,
-                                             partition,
-                                             mount_point)
-        attempts = 5
-        while not os.path.exists(partition) and attempts > 0:
-            logger.info("Waiting for partition [{0}], {1} attempts remaining",
-                        partition,
-                        attempts)
-            sleep(5)
-            attempts -= 1
-
-        if not os.path.exists(partition):
+        if not self._wait_for_partition(partition):
             raise ResourceDiskError(
                 "Partition was not created [{0}]".format(partition))
 
-        logger.info("Mount resource disk [{0}]", mount_string)
-        ret, output = shellutil.run_get_output(mount_string, chk_err=False)
-        # if the exit code is 32, then the resource disk can be already mounted
-        if ret == 32 and output.find("is already mounted") != -1:
-            logger.warn("Could not mount resource disk: {0}", output)
-        elif ret != 0:
-            # Some kernels seem to issue an async partition re-read after a
-            # 'parted' command invocation. This causes mount to fail if the
-            # partition re-read is not complete by the time mount is
-            # attempted. Seen in CentOS 7.2. Force a sequential re-read of
-            # the partition and try mounting.
-            logger.warn("Failed to mount resource disk. "
-                        "Retry mounting after re-reading partition info.")
-
-            self.reread_partition_table(device)
-
-            ret, output = shellutil.run_get_output(mount_string, chk_err=False)
-            if ret:
-                logger.warn("Failed to mount resource disk. "
-                            "Attempting to format and retry mount. [{0}]",
-                            output)
-
-                shellutil.run(mkfs_string)
-                ret, output = shellutil.run_get_output(mount_string)
-                if ret:
-                    raise ResourceDiskError("Could not mount {0} "
-                                            "after syncing partition table: "
-                                            "[{1}] {2}".format(partition,
-                                                               ret,
-                                                               output))
+        logger.info("Mount resource disk [{0}]", " ".join(mount_command))
+        try:
+            self._mount(mount_command)
+        except CommandError as mount_error:
+            # if the exit code is 32, then the resource disk can be already mounted
+            if mount_error.returncode == 32 and mount_error.stderr.find("is already mounted") != -1:
+                logger.warn("Could not mount resource disk: {0}", mount_error.stderr)
+            else:
+                self._retry_mount_resource_disk(device, partition, mount_command, mkfs_command)
 
         logger.info("Resource disk {0} is mounted at {1} with {2}",
                     device,
@@ -217,28 +368,88 @@ class ResourceDiskHandler(object):
                     self.fs)
         return mount_point
 
-    def change_partition_type(self, suppress_message, option_str):
+    def _retry_mount_resource_disk(self, device, partition, mount_command, mkfs_command):
+        # Some kernels seem to issue an async partition re-read after a
+        # 'parted' command invocation. This causes mount to fail if the
+        # partition re-read is not complete by the time mount is
+        # attempted. Seen in CentOS 7.2. Force a sequential re-read of
+        # the partition, wait for udev to process it and try mounting.
+        logger.warn("Failed to mount resource disk. "
+                    "Retry mounting after re-reading partition info.")
+
+        self.reread_partition_table(device)
+
+        try:
+            self._mount(mount_command)
+            return
+        except CommandError as mount_error:
+            logger.warn("Failed to mount resource disk. "
+                        "Attempting to format and retry mount. [{0}]",
+                        mount_error.stderr)
+
+        self._try_run_command(mkfs_command, log_error=True)
+        try:
+            self._mount(mount_command, log_error=True)
+        except CommandError as mount_error:
+            raise ResourceDiskError("Could not mount {0} "
+                                    "after syncing partition table: "
+                                    "[{1}] {2}".format(partition,
+                                                       mount_error.returncode,
+                                                       mount_error.stderr))
+
+    @staticmethod
+    def get_partition_table_info(device):
+        """
+        Returns a tuple (is_gpt, partition_count) describing the partition
+        table of 'device'. Uses the JSON output of lsblk, falling back to
+        parsing the output of parted where lsblk does not support -J.
+        """
+        # stdout only: warnings on stderr would break the JSON output
+        output = None
+        try:
+            output = shellutil.run_command(["lsblk", "-J", "-o", "NAME,PTTYPE,FSTYPE", device])
+        except (CommandError, OSError) as e:
+            logger.info("lsblk failed: {0}", ustr(e))
+        if output is not None:
+            try:
+                disk = json.loads(output)["blockdevices"][0]
+                return disk.get("pttype") == "gpt", len(disk.get("children") or [])
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                logger.info("Could not parse the output of lsblk [{0}]: {1}", output, ustr(e))
+
+        ret, output = shellutil.run_get_output("parted {0} print".format(device))
+        if ret:
+            raise ResourceDiskError("Could not determine partition info for "
+                                    "{0}: {1}".format(device, output))
+        parts = [x for x in output.split("\n") if _PARTED_PARTITION_LINE_RE.match(x)]
+        return "gpt" in output, len(parts)
+
+    def change_partition_type(self, suppress_message, options):
         """
             use sfdisk to change partition type.
             First try with --part-type; if fails, fall back to -c
         """
 
-        option_to_use = '--part-type'
-        command = "sfdisk {0} {1} {2}".format(
-            option_to_use, '-f' if suppress_message else '', option_str)
-        err_code, output = shellutil.run_get_output(
-            command, chk_err=False, log_cmd=True)
+        def run_sfdisk(option_to_use):
+            command = ["sfdisk", option_to_use] + (["-f"] if suppress_message else []) + options
+            logger.verbose(u"Command: [{0}]", " ".join(command))
+            try:
+                return command, 0, shellutil.run_command(command)
+            except CommandError as e:
+                return command, e.returncode, e.stderr
+            except OSError as e:
+                return command, -1, ustr(e)
+
+        command, err_code, output = run_sfdisk('--part-type')
 
         # fall back to -c
         if err_code != 0:
             logger.info(
                 "sfdisk with --part-type failed [{0}], retrying with -c",
                 err_code)
-            option_to_use = '-c'
-            command = "sfdisk {0} {1} {2}".format(
-                option_to_use, '-f' if suppress_message else '', option_str)
-            err_code, output = shellutil.run_get_output(command, log_cmd=True)
+            command, err_code, output = run_sfdisk('-c')
 
+        command = " ".join(command)
         if err_code == 0:
             logger.info('{0} succeeded',
                         command)
@@ -250,28 +461,42 @@ class ResourceDiskHandler(object):
 
         return err_code, output
 
+    def get_mount_command(self, mount_options, partition, mount_point):
+        command = ["mount", "-t", self.fs]
+        if mount_options is not None:
+            command.extend(["-o", mount_options])
+        return command + [partition, mount_point]
+
     def get_mount_string(self, mount_options, partition, mount_point):
         if mount_options is not None:
-            return 'mount -t {0} -o {1} {2} {3}'.format(
-                self.fs,
-                mount_options,
-                partition,
-                mount_point
-            )
-        else:
-            return 'mount -t {0} {1} {2}'.format(
-                self.fs,
-                partition,
-                mount_point
-            )
+            return _MOUNT_COMMAND_WITH_OPTIONS.format(self.fs, mount_options, partition, mount_point)
+        return _MOUNT_COMMAND.format(self.fs, partition, mount_point)
+
+    @staticmethod
+    def _get_file_stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
 
     @staticmethod
     def check_existing_swap_file(swapfile, swaplist, size):
-        if swapfile in swaplist and os.path.isfile(
-                swapfile) and os.path.getsize(swapfile) == size:
+        if swapfile not in swaplist:
+            return False
+        swapfile_stat = ResourceDiskHandler._get_file_stat(swapfile)
+        return swapfile_stat is not None and ResourceDiskHandler._check_active_swap_file(swapfile, swapfile_stat, size)
+
+    @staticmethod
+    def _check_active_swap_file(swapfile, swapfile_stat, size):
+        """
+        Given the stat of a swap file that is known to be active, returns
+        True if it is the expected swap file and restricts its access to the
+        owner if needed.
+        """
+        if stat.S_ISREG(swapfile_stat.st_mode) and swapfile_stat.st_size == size:
             logger.info("Swap already enabled")
             # restrict access to owner (remove all access from group, others)
-            swapfile_mode = os.stat(swapfile).st_mode
+            swapfile_mode = swapfile_stat.st_mode
             if swapfile_mode & (stat.S_IRWXG | stat.S_IRWXO):
                 swapfile_mode = swapfile_mode & ~(stat.S_IRWXG | stat.S_IRWXO)
                 logger.info(
@@ -282,25 +507,45 @@ class ResourceDiskHandler(object):
 
         return False
 
+    @staticmethod
+    def get_swap_list():
+        """
+        Returns the list of active swap areas, as reported by /proc/swaps or,
+        if that is not available, by 'swapon -s'.
+        """
+        try:
+            return fileutil.read_file(_SWAPS_PATH)
+        except (IOError, OSError) as e:
+            logger.info("Could not read {0}: {1}", _SWAPS_PATH, ustr(e))
+            return shellutil.run_get_output("swapon -s")[1]
+
     def create_swap_space(self, mount_point, size_mb):
         size_kb = size_mb * 1024
         size = size_kb * 1024
         swapfile = os.path.join(mount_point, 'swapfile')
-        swaplist = shellutil.run_get_output("swapon -s")[1]
+        swaplist = self.get_swap_list()
+
+        # stat the swap file once and decide on the action from it
+        swapfile_stat = self._get_file_stat(swapfile)
 
-        if self.check_existing_swap_file(swapfile, swaplist, size):
+        if swapfile_stat is not None and swapfile in swaplist and \
+                self._check_active_swap_file(swapfile, swapfile_stat, size):
             return
 
-        if os.path.isfile(swapfile) and os.path.getsize(swapfile) != size:
+        is_file = swapfile_stat is not None and stat.S_ISREG(swapfile_stat.st_mode)
+        if is_file and swapfile_stat.st_size != size:
             logger.info("Remove old swap file")
-            shellutil.run("swapoff {0}".format(swapfile), chk_err=False)
+            self._try_run_command(["swapoff", swapfile])
             os.remove(swapfile)
+            is_file = False
 
-        if not os.path.isfile(swapfile):
+        if is_file:
+            enabled = self._try_run_command(["swapon", swapfile], log_error=True)
+        else:
             logger.info("Create swap file")
             self.mkfile(swapfile, size_kb * 1024)
-            shellutil.run("mkswap {0}".format(swapfile))
-        if shellutil.run("swapon {0}".format(swapfile)):
+            enabled = shellutil.run("mkswap {0} && swapon {0}".format(swapfile)) == 0
+        if not enabled:
             raise ResourceDiskError("{0}".format(swapfile))
         logger.info("Enabled {0}KB of swap at {1}".format(size_kb, swapfile))
 
@@ -315,9 +560,7 @@ class ResourceDiskHandler(object):
         command
         in the popular ``util-linux{,-ng}`` package.
 
-        A dd fallback will be tried too. When size < 64M, perform
-        single-pass dd.
-        Otherwise do two-pass dd.
+        If both fail, the file is filled with zeros in-process.
         """
 
         if not isinstance(nbytes, int):
@@ -326,15 +569,17 @@ class ResourceDiskHandler(object):
         if nbytes <= 0:
             raise ResourceDiskError("Invalid swap size [{0}]".format(nbytes))
 
-        if os.path.isfile(filename):
+        try:
             os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise ResourceDiskError(msg="Failed to remove {0}".format(filename), inner=e)
 
-        # If file system is xfs, use dd right away as we have been reported that
-        # swap enabling fails in xfs fs when disk space is allocated with
-        # fallocate
-        ret = 0
+        # On xfs and ext4, write zeros right away on older kernels as we have
+        # been reported that swap enabling fails when disk space is allocated
+        # with fallocate
         fn_sh = shellutil.quote((filename,))
-        if self.fs not in ['xfs', 'ext4']:
+        if self.fs not in ['xfs', 'ext4'] or self._kernel_supports_preallocated_swap():
             # os.posix_fallocate
             if sys.version_info >= (3, 3):
                 # Probable errors:
@@ -362,24 +607,38 @@ class ResourceDiskHandler(object):
             if ret == 0:
                 return ret
 
-            logger.info("fallocate unsuccessful, falling back to dd")
-
-        # dd fallback
-        dd_maxbs = 64 * 1024 ** 2
-        dd_cmd = "umask 0077 && dd if=/dev/zero bs={0} count={1} " \
-                 "conv=notrunc of={2}"
-
-        blocks = int(nbytes / dd_maxbs)
-        if blocks > 0:
-            ret = shellutil.run(dd_cmd.format(dd_maxbs, blocks, fn_sh)) << 8
+            logger.info("fallocate unsuccessful, falling back to zero-filling the file")
 
-        remains = int(nbytes % dd_maxbs)
-        if remains > 0:
-            ret += shellutil.run(dd_cmd.format(remains, 1, fn_sh))
+        # zero-fill fallback
+        try:
+            self._zero_fill(filename, nbytes)
+            logger.info("Zero-filling {0} successful", filename)
+            return 0
+        except (OSError, IOError) as e:
+            logger.error("Zero-filling {0} unsuccessful: {1}", filename, ustr(e))
+            return 1
 
-        if ret == 0:
-            logger.info("dd successful")
-        else:
-            logger.error("dd unsuccessful")
+    @staticmethod
+    def _kernel_supports_preallocated_swap():
+        """
+        Starting with Linux 4.18 swapon accepts files allocated with fallocate
+        on xfs; older kernels consider them to have holes.
+        """
+        match = re.match(r"^(\d+)\.(\d+)", platform.release())
+        return match is not None and (int(match.group(1)), int(match.group(2))) >= _PREALLOCATED_SWAP_MIN_KERNEL
 
-        return ret
+    @staticmethod
+    def _zero_fill(filename, nbytes):
+        """
+        Writes 'nbytes' zero bytes to 'filename' in-process, creating it with
+        access restricted to the owner if it does not exist.
+        """
+        chunk_size = 1024 ** 2
+        zeros = b"\0" * chunk_size
+        fd = os.open(filename, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR)
+        try:
+            remaining = nbytes
+            while remaining > 0:
+                remaining -= os.write(fd, zeros if remaining >= chunk_size else zeros[:remaining])
+        finally:
+            os.close(fd)
@@ -20,7 +20,6 @@
 import azurelinuxagent.common.logger as logger
 import azurelinuxagent.common.utils.fileutil as fileutil
 import azurelinuxagent.common.utils.shellutil as shellutil
-import azurelinuxagent.common.conf as conf
 from azurelinuxagent.common.exception import ResourceDiskError
 from azurelinuxagent.daemon.resourcedisk.default import ResourceDiskHandler
 
@@ -35,7 +34,7 @@ class OpenBSDResourceDiskHandler(ResourceDiskHandler):
         pass
 
     def enable_swap(self, mount_point):
-        size_mb = conf.get_resourcedisk_swap_size_mb()
+        size_mb = self._swap_size_mb
         if size_mb:
             logger.info("Enable swap")
             device = self.osutil.device_for_ide_port(1)
@@ -82,7 +81,7 @@ class OpenBSDResourceDiskHandler(ResourceDiskHandler):
                 raise ResourceDiskError("Failed to create new MBR on {0}, "
                                         "error: {1}".format(device, output))
 
-            size_mb = conf.get_resourcedisk_swap_size_mb()
+            size_mb = self._swap_size_mb
             if size_mb:
                 if size_mb > 512 * 1024:
                     size_mb = 512 * 1024
@@ -18,12 +18,10 @@
 # Requires Python 2.6+ and Openssl 1.0+
 #
 import os
-from time import sleep
 
 import azurelinuxagent.common.logger as logger
 import azurelinuxagent.common.utils.fileutil as fileutil
 import azurelinuxagent.common.utils.shellutil as shellutil
-import azurelinuxagent.common.conf as conf
 from azurelinuxagent.common.exception import ResourceDiskError
 from azurelinuxagent.daemon.resourcedisk.default import ResourceDiskHandler
 
@@ -51,8 +49,7 @@ class OpenWRTResourceDiskHandler(ResourceDiskHandler):
         logger.info('Resource disk partition {0} found.', partition)
 
         # 3. Mount partition
-        mount_list = shellutil.run_get_output("mount")[1]
-        existing = self.osutil.get_mount_point(mount_list, device)
+        existing = self.get_existing_mount_point(device)
         if existing:
             logger.info("Resource disk [{0}] is already mounted [{1}]",
                         partition,
@@ -73,31 +70,22 @@ class OpenWRTResourceDiskHandler(ResourceDiskHandler):
         mkfs_string = "mkfs.{0} -{2} {1}".format(self.fs, partition, force_option)
 
         # Compare to the Default mount_resource_disk, we don't check for GPT that is not supported on OpenWRT
-        ret = self.change_partition_type(suppress_message=True, option_str="{0} 1 -n".format(device))
+        ret = self.change_partition_type(suppress_message=True, options=[device, "1", "-n"])
         ptype = ret[1].strip()
         if ptype == "7" and self.fs != "ntfs":
             logger.info("The partition is formatted with ntfs, updating "
                         "partition type to 83")
-            self.change_partition_type(suppress_message=False, option_str="{0} 1 83".format(device))
+            self.change_partition_type(suppress_message=False, options=[device, "1", "83"])
             self.reread_partition_table(device)
             logger.info("Format partition [{0}]", mkfs_string)
             shellutil.run(mkfs_string)
         else:
             logger.info("The partition type is {0}", ptype)
 
-        mount_options = conf.get_resourcedisk_mountoptions()
-        mount_string = self.get_mount_string(mount_options,
+        mount_string = self.get_mount_string(self._mount_options,
                                              partition,
                                              mount_point)
-        attempts = 5
-        while not os.path.exists(partition) and attempts > 0:
-            logger.info("Waiting for partition [{0}], {1} attempts remaining",
-                        partition,
-                        attempts)
-            sleep(5)
-            attempts -= 1
-
-        if not os.path.exists(partition):
+        if not self._wait_for_partition(partition):
             raise ResourceDiskError("Partition was not created [{0}]".format(partition))
 
         if os.path.ismount(mount_point):
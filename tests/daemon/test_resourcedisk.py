@@ -15,9 +15,12 @@
 # Requires Python 2.6+ and Openssl 1.0+
 #
 
+import os
 import unittest
 
 from tests.tools import AgentTestCase, patch, DEFAULT
+from azurelinuxagent.common.exception import ResourceDiskError
+from azurelinuxagent.common.utils.shellutil import CommandError
 from azurelinuxagent.daemon.resourcedisk.default import ResourceDiskHandler
 
 
@@ -39,18 +42,240 @@ class TestResourceDisk(AgentTestCase):
         rdh = ResourceDiskHandler()
         mount_string = rdh.get_mount_string(options, partition, mountpoint)
         self.assertEqual(expected, mount_string)
+        self.assertEqual(expected.split(), rdh.get_mount_command(options, partition, mountpoint))
+
+    def test_get_existing_mount_point(self):
+        mountinfo = os.path.join(self.tmp_dir, 'mountinfo')
+        with open(mountinfo, 'w') as f:
+            f.write('22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+                    '23 22 0:5 / /dev rw,nosuid shared:2 - devtmpfs udev rw,mode=755\n'
+                    '98 22 8:17 / /mnt/resource rw,relatime shared:40 master:3 - ext4 /dev/sdb1 rw\n')
+
+        with patch('azurelinuxagent.daemon.resourcedisk.default._MOUNTINFO_PATH', mountinfo):
+            rdh = ResourceDiskHandler()
+            self.assertEqual('/mnt/resource', rdh.get_existing_mount_point('/dev/sdb'))
+            self.assertEqual('/', rdh.get_existing_mount_point('/dev/sda'))
+            self.assertIsNone(rdh.get_existing_mount_point('/dev/sdc'))
+
+    @patch('azurelinuxagent.common.utils.shellutil.run_get_output',
+           return_value=(0, '/dev/sda1 on / type ext4 (rw)\n/dev/sdb1 on /mnt/resource type ext4 (rw)\n'))
+    def test_get_existing_mount_point_should_fall_back_to_mount(self, mock_run_get_output):
+        with patch('azurelinuxagent.daemon.resourcedisk.default._MOUNTINFO_PATH', os.path.join(self.tmp_dir, 'no_such_file')):
+            self.assertEqual('/mnt/resource', ResourceDiskHandler().get_existing_mount_point('/dev/sdb'))
+        self.assertEqual('mount', mock_run_get_output.call_args[0][0])
+
+    @patch('azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler.enable_swap')
+    @patch('azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler.activate_resource_disk')
+    def test_run_should_do_nothing_when_format_is_disabled(self, mock_activate, mock_enable_swap):
+        with patch('azurelinuxagent.common.conf.get_resourcedisk_format', return_value=False):
+            rdh = ResourceDiskHandler()
+        rdh.run()
+
+        self.assertEqual(0, mock_activate.call_count)
+        self.assertEqual(0, mock_enable_swap.call_count)
+
+    @patch('azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler.run')
+    def test_start_activate_resource_disk_should_start_a_single_thread(self, mock_run):
+        rdh = ResourceDiskHandler()
+
+        with patch('azurelinuxagent.daemon.resourcedisk.default.threading.Thread') as mock_thread:
+            rdh.start_activate_resource_disk()
+            rdh.start_activate_resource_disk()
+
+        self.assertEqual(1, mock_thread.call_count)
+        self.assertEqual(mock_run, mock_thread.call_args[1]['target'])
+        mock_thread.return_value.setDaemon.assert_called_once_with(True)
+        self.assertEqual(1, mock_thread.return_value.start.call_count)
+
+    def test_activate_resource_disk_should_skip_a_mount_point_that_is_being_activated(self):
+        rdh = ResourceDiskHandler()
+        results = []
+
+        def mount_resource_disk(mount_point):
+            # a second activation while this one is in progress should be skipped
+            results.append(rdh.activate_resource_disk())
+            return mount_point
+
+        with patch.object(rdh, 'mount_resource_disk', side_effect=mount_resource_disk):
+            with patch('azurelinuxagent.common.utils.fileutil.write_file'):
+                self.assertEqual(rdh._mount_point, rdh.activate_resource_disk())  # pylint: disable=protected-access
+                self.assertEqual([None], results)
+
+                # once the activation completes, the mount point can be activated again
+                with patch.object(rdh, 'mount_resource_disk', side_effect=lambda mount_point: mount_point):
+                    self.assertEqual(rdh._mount_point, rdh.activate_resource_disk())  # pylint: disable=protected-access
+
+    def test_get_swap_list(self):
+        swaps = os.path.join(self.tmp_dir, 'swaps')
+        with open(swaps, 'w') as f:
+            f.write('Filename\t\t\t\tType\t\tSize\tUsed\tPriority\n/mnt/resource/swapfile                 \tfile    \t131068\t0\t-2\n')
+
+        with patch('azurelinuxagent.daemon.resourcedisk.default._SWAPS_PATH', swaps):
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output') as mock_run_get_output:
+                self.assertIn('/mnt/resource/swapfile', ResourceDiskHandler.get_swap_list())
+                self.assertEqual(0, mock_run_get_output.call_count)
+
+        with patch('azurelinuxagent.daemon.resourcedisk.default._SWAPS_PATH', os.path.join(self.tmp_dir, 'no_such_file')):
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output', return_value=(0, 'swapon output')) as mock_run_get_output:
+                self.assertEqual('swapon output', ResourceDiskHandler.get_swap_list())
+                self.assertEqual('swapon -s', mock_run_get_output.call_args[0][0])
+
+    def test_get_partition_table_info_from_lsblk(self):
+        lsblk_output = '{"blockdevices": [{"name": "sdb", "pttype": "gpt", "fstype": null, "children": [' \
+                       '{"name": "sdb1", "pttype": "gpt", "fstype": "ext4"}, {"name": "sdb2", "pttype": "gpt", "fstype": null}]}]}'
+        with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value=lsblk_output) as mock_run_command:
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output') as mock_run_get_output:
+                self.assertEqual((True, 2), ResourceDiskHandler.get_partition_table_info('/dev/sdb'))
+            self.assertEqual(['lsblk', '-J', '-o', 'NAME,PTTYPE,FSTYPE', '/dev/sdb'], mock_run_command.call_args[0][0])
+            self.assertEqual(0, mock_run_get_output.call_count)
+
+        lsblk_output = '{"blockdevices": [{"name": "sdb", "pttype": null, "fstype": null}]}'
+        with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value=lsblk_output):
+            self.assertEqual((False, 0), ResourceDiskHandler.get_partition_table_info('/dev/sdb'))
+
+    def test_get_partition_table_info_should_fall_back_to_parted(self):
+        parted_output = 'Partition Table: gpt\n\nNumber  Start   End     Size    File system  Name     Flags\n' \
+                        ' 1      1049kB  2097kB  1049kB                        bios_grub\n' \
+                        ' 2      2097kB  7517MB  7515MB  ext4\n'
+
+        lsblk_error = CommandError(command='lsblk', return_code=1, stdout='', stderr="lsblk: unknown option -- 'J'")
+
+        with patch('azurelinuxagent.common.utils.shellutil.run_command', side_effect=lsblk_error):
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output', return_value=(0, parted_output)):
+                self.assertEqual((True, 2), ResourceDiskHandler.get_partition_table_info('/dev/sdb'))
+
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output', return_value=(1, 'error')):
+                self.assertRaises(ResourceDiskError, ResourceDiskHandler.get_partition_table_info, '/dev/sdb')
+
+        with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value='not json'):
+            with patch('azurelinuxagent.common.utils.shellutil.run_get_output', return_value=(0, parted_output)):
+                self.assertEqual((True, 2), ResourceDiskHandler.get_partition_table_info('/dev/sdb'))
+
+    def test_run_stages_should_stop_at_the_first_failure(self):
+        ret, output, stage = ResourceDiskHandler._run_stages([  # pylint: disable=protected-access
+            ("first", "echo one"),
+            ("second", "false"),
+            ("third", "echo three")])
+
+        self.assertNotEqual(0, ret)
+        self.assertEqual("second", stage)
+        self.assertIn("one", output)
+        self.assertNotIn("three", output)
+
+    def test_run_stages_should_run_all_stages(self):
+        ret, _, stage = ResourceDiskHandler._run_stages([("first", "true"), ("second", "true")])  # pylint: disable=protected-access
+
+        self.assertEqual(0, ret)
+        self.assertEqual("second", stage)
+
+    @patch('azurelinuxagent.common.utils.shellutil.run_command', return_value='')
+    def test_reread_partition_table_should_reread_and_wait_for_udev(self, mock_run_command):
+        ResourceDiskHandler().reread_partition_table('/dev/sdb')
+
+        self.assertEqual([['blockdev', '--rereadpt', '/dev/sdb'], ['udevadm', 'settle', '--timeout=30']],
+                         [args[0][0] for args in mock_run_command.call_args_list])
+
+    @patch('azurelinuxagent.common.utils.shellutil.run_command',
+           side_effect=[CommandError(command='blockdev', return_code=1, stdout='', stderr='Device or resource busy'),
+                        OSError(2, 'No such file or directory')])
+    def test_reread_partition_table_should_ignore_failures(self, mock_run_command):
+        ResourceDiskHandler().reread_partition_table('/dev/sdb')
+
+        self.assertEqual(2, mock_run_command.call_count)
+
+    def test_mount_resource_disk_should_settle_udev_before_formatting_a_recreated_gpt_partition(self):
+        rdh = ResourceDiskHandler()
+
+        with patch.object(rdh.osutil, 'device_for_ide_port', return_value='sdb'):
+            with patch.object(rdh, 'get_existing_mount_point', return_value=None):
+                with patch.object(rdh, 'get_partition_table_info', return_value=(True, 2)):
+                    with patch.object(rdh, '_run_stages', return_value=(0, '', 'mkfs')) as mock_run_stages:
+                        with patch.object(rdh, '_wait_for_partition', return_value=True):
+                            with patch('azurelinuxagent.common.utils.fileutil.mkdir'):
+                                with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value=''):
+                                    rdh.mount_resource_disk('/mnt/resource')
+
+        self.assertEqual(1, mock_run_stages.call_count)
+        self.assertEqual([
+            ("parted", "parted -s /dev/sdb rm 1 rm 2 mkpart primary 0% 100%"),
+            ("reread", "{ blockdev --rereadpt /dev/sdb; udevadm settle --timeout=30; } || true"),
+            ("mkfs", "mkfs.ext3 -F /dev/sdb1")], mock_run_stages.call_args[0][0])
+
+    def test_mount_resource_disk_should_format_the_gpt_partition_when_parted_fails(self):
+        rdh = ResourceDiskHandler()
+        parted_error = (1, '::STAGE::parted\nError: Partition(s) 1 on /dev/sdb have been written, but we have been unable to inform the kernel', 'parted')
+
+        with patch.object(rdh.osutil, 'device_for_ide_port', return_value='sdb'):
+            with patch.object(rdh, 'get_existing_mount_point', return_value=None):
+                with patch.object(rdh, 'get_partition_table_info', return_value=(True, 2)):
+                    with patch.object(rdh, '_run_stages', return_value=parted_error):
+                        with patch.object(rdh, 'reread_partition_table') as mock_reread:
+                            with patch.object(rdh, '_wait_for_partition', return_value=True):
+                                with patch('azurelinuxagent.common.utils.fileutil.mkdir'):
+                                    with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value='') as mock_run_command:
+                                        rdh.mount_resource_disk('/mnt/resource')
+
+        mock_reread.assert_called_once_with('/dev/sdb')
+        self.assertEqual([
+            ['mkfs.ext3', '-F', '/dev/sdb1'],
+            ['mount', '-t', 'ext3', '/dev/sdb1', '/mnt/resource']],
+            [c[0][0] for c in mock_run_command.call_args_list])
+
+    def test_mount_resource_disk_should_not_retry_when_the_disk_is_already_mounted(self):
+        rdh = ResourceDiskHandler()
+        already_mounted = CommandError(['mount'], 32, '', 'mount: /dev/sdb1 is already mounted or /mnt/resource busy')
+
+        with patch.object(rdh.osutil, 'device_for_ide_port', return_value='sdb'):
+            with patch.object(rdh, 'get_existing_mount_point', return_value=None):
+                with patch.object(rdh, 'get_partition_table_info', return_value=(False, 1)):
+                    with patch.object(rdh, 'change_partition_type', return_value=(0, '83')):
+                        with patch.object(rdh, '_wait_for_partition', return_value=True):
+                            with patch.object(rdh, 'reread_partition_table') as mock_reread:
+                                with patch('azurelinuxagent.common.utils.fileutil.mkdir'):
+                                    with patch('azurelinuxagent.common.utils.shellutil.run_command', side_effect=already_mounted) as mock_run_command:
+                                        self.assertEqual('/mnt/resource', rdh.mount_resource_disk('/mnt/resource'))
+
+        self.assertEqual(1, mock_run_command.call_count, "mount should have run only once")
+        self.assertEqual(0, mock_reread.call_count, "The partition table should not have been re-read")
+
+    def test_mount_resource_disk_should_reread_the_partition_table_before_retrying_the_mount(self):
+        rdh = ResourceDiskHandler()
+        commands = []
+
+        mount_results = [CommandError(['mount'], 1, '', 'mount: wrong fs type'), None]
+
+        def run_command(command, **kwargs):  # pylint: disable=unused-argument
+            commands.append(command)
+            if command[0] == 'mount':
+                error = mount_results.pop(0)
+                if error is not None:
+                    raise error
+            return ''
+
+        with patch.object(rdh.osutil, 'device_for_ide_port', return_value='sdb'):
+            with patch.object(rdh, 'get_existing_mount_point', return_value=None):
+                with patch.object(rdh, 'get_partition_table_info', return_value=(False, 1)):
+                    with patch.object(rdh, 'change_partition_type', return_value=(0, '83')):
+                        with patch.object(rdh, '_wait_for_partition', return_value=True):
+                            with patch('azurelinuxagent.common.utils.fileutil.mkdir'):
+                                with patch('azurelinuxagent.common.utils.shellutil.run_command', side_effect=run_command):
+                                    self.assertEqual('/mnt/resource', rdh.mount_resource_disk('/mnt/resource'))
+
+        mount_command = ['mount', '-t', 'ext3', '/dev/sdb1', '/mnt/resource']
+        # no mkfs: the partition should not have been formatted
+        self.assertEqual([
+            mount_command,
+            ['blockdev', '--rereadpt', '/dev/sdb'],
+            ['udevadm', 'settle', '--timeout=30'],
+            mount_command], commands)
 
     @patch('azurelinuxagent.common.utils.shellutil.run_get_output')
     @patch('azurelinuxagent.common.utils.shellutil.run')
     @patch('azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler.mkfile')
-    @patch('azurelinuxagent.daemon.resourcedisk.default.os.path.isfile', return_value=False)
-    @patch(
-        'azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler.check_existing_swap_file',
-        return_value=False)
+    @patch('azurelinuxagent.daemon.resourcedisk.default.ResourceDiskHandler._get_file_stat', return_value=None)
     def test_create_swap_space(
             self,
-            mock_check_existing_swap_file,  # pylint: disable=unused-argument
-            mock_isfile,  # pylint: disable=unused-argument
+            mock_get_file_stat,  # pylint: disable=unused-argument
             mock_mkfile,  # pylint: disable=unused-argument
             mock_run,
             mock_run_get_output):
@@ -80,6 +305,43 @@ class TestResourceDisk(AgentTestCase):
             size_mb=size_mb
         )
 
+    def test_create_swap_space_should_replace_a_swap_file_of_the_wrong_size(self):
+        mount_point = self.tmp_dir
+        swapfile = os.path.join(mount_point, 'swapfile')
+        with open(swapfile, "wb") as f:
+            f.write(bytearray(1024))
+
+        rdh = ResourceDiskHandler()
+        with patch.object(rdh, 'get_swap_list', return_value=swapfile):
+            with patch.object(rdh, 'mkfile') as mock_mkfile:
+                with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value='') as mock_run_command:
+                    with patch('azurelinuxagent.common.utils.shellutil.run', return_value=0) as mock_run:
+                        rdh.create_swap_space(mount_point=mount_point, size_mb=1)
+
+        self.assertFalse(os.path.exists(swapfile), "The old swap file should have been removed")
+        mock_mkfile.assert_called_once_with(swapfile, 1024 * 1024)
+        self.assertEqual(['swapoff', swapfile], mock_run_command.call_args[0][0])
+        self.assertEqual('mkswap {0} && swapon {0}'.format(swapfile), mock_run.call_args[0][0])
+
+    def test_create_swap_space_should_enable_an_existing_swap_file(self):
+        mount_point = self.tmp_dir
+        swapfile = os.path.join(mount_point, 'swapfile')
+        with open(swapfile, "wb") as f:
+            f.write(bytearray(1024 * 1024))
+
+        rdh = ResourceDiskHandler()
+        with patch.object(rdh, 'get_swap_list', return_value=''):
+            with patch.object(rdh, 'mkfile') as mock_mkfile:
+                with patch('azurelinuxagent.common.utils.shellutil.run_command', return_value='') as mock_run_command:
+                    rdh.create_swap_space(mount_point=mount_point, size_mb=1)
+
+        self.assertEqual(0, mock_mkfile.call_count, "The swap file should not have been recreated")
+        mock_run_command.assert_called_once_with(['swapon', swapfile], log_error=True)
+
+        with patch.object(rdh, 'get_swap_list', return_value=''):
+            with patch('azurelinuxagent.common.utils.shellutil.run_command', side_effect=CommandError(['swapon'], 255, '', 'swapon failed')):
+                self.assertRaises(ResourceDiskError, rdh.create_swap_space, mount_point=mount_point, size_mb=1)
+
 
 if __name__ == '__main__':
     unittest.main()
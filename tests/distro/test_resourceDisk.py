@@ -21,8 +21,11 @@
 import os
 import stat
 import sys
+import threading
+import time
 import unittest
 from azurelinuxagent.common.utils import shellutil
+from azurelinuxagent.common.utils.shellutil import CommandError
 from azurelinuxagent.daemon.resourcedisk import get_resourcedisk_handler
 from tests.tools import AgentTestCase, patch
 
@@ -49,7 +52,7 @@ class TestResourceDisk(AgentTestCase):
         # cleanup
         os.remove(test_file)
 
-    def test_mkfile_dd_fallback(self):
+    def test_mkfile_zero_fill_fallback(self):
         with patch.object(shellutil, "run") as run_patch:
             # setup
             run_patch.return_value = 1
@@ -65,9 +68,12 @@ class TestResourceDisk(AgentTestCase):
                 get_resourcedisk_handler().mkfile(test_file, file_size)
 
             # assert
-            assert run_patch.call_count > 1
+            assert run_patch.call_count == 1
             assert "fallocate" in run_patch.call_args_list[0][0][0]
-            assert "dd if" in run_patch.call_args_list[-1][0][0]
+            assert os.path.getsize(test_file) == file_size
+            mode = os.stat(test_file).st_mode & (
+                stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+            assert mode == stat.S_IRUSR | stat.S_IWUSR
 
     def test_mkfile_xfs_fs(self):
         # setup
@@ -81,38 +87,106 @@ class TestResourceDisk(AgentTestCase):
         resource_disk_handler.fs = 'xfs'
 
         with patch.object(shellutil, "run") as run_patch:
-            resource_disk_handler.mkfile(test_file, file_size)
+            with patch("platform.release", return_value="3.10.0-1160.el7.x86_64"):
+                resource_disk_handler.mkfile(test_file, file_size)
 
             # assert
             if sys.version_info >= (3, 3):
                 with patch("os.posix_fallocate") as posix_fallocate:
                     self.assertEqual(0, posix_fallocate.call_count)
 
-            assert run_patch.call_count == 1
-            assert "dd if" in run_patch.call_args_list[0][0][0]
+            assert run_patch.call_count == 0
+            assert os.path.getsize(test_file) == file_size
+
+    def test_wait_for_partition_should_return_when_the_partition_is_created(self):
+        partition = os.path.join(self.tmp_dir, 'sdb1')
+
+        def create_partition():
+            time.sleep(0.5)
+            with open(partition, "w"):
+                pass
+
+        creator = threading.Thread(target=create_partition)
+        creator.start()
+        try:
+            start = time.time()
+            self.assertTrue(get_resourcedisk_handler()._wait_for_partition(partition, timeout=10))  # pylint: disable=protected-access
+            self.assertTrue(time.time() - start < 5, "The wait should end as soon as the partition shows up")
+        finally:
+            creator.join()
+
+    def test_wait_for_partition_should_poll_when_inotify_is_not_available(self):
+        partition = os.path.join(self.tmp_dir, 'sdb1')
+        handler = get_resourcedisk_handler()
+
+        with patch.object(handler, "_inotify_watch", return_value=None):
+            self.assertFalse(handler._wait_for_partition(partition, timeout=1))  # pylint: disable=protected-access
+
+            with open(partition, "w"):
+                pass
+            self.assertTrue(handler._wait_for_partition(partition, timeout=1))  # pylint: disable=protected-access
+
+    def test_mkfile_xfs_fs_should_use_fallocate_on_newer_kernels(self):
+        test_file = os.path.join(self.tmp_dir, 'test_file')
+        file_size = 1024 * 128
+
+        resource_disk_handler = get_resourcedisk_handler()
+        resource_disk_handler.fs = 'xfs'
+
+        with patch.object(shellutil, "run", return_value=0) as run_patch:
+            with patch("platform.release", return_value="5.15.0-1019-azure"):
+                with patch.object(resource_disk_handler, "_zero_fill") as zero_fill_patch:
+                    resource_disk_handler.mkfile(test_file, file_size)
+
+        self.assertEqual(0, zero_fill_patch.call_count)
+        if sys.version_info < (3, 3):
+            self.assertTrue("fallocate" in run_patch.call_args_list[0][0][0])
+        else:
+            self.assertEqual(file_size, os.path.getsize(test_file))
+
+    def test_wait_for_partition_should_not_be_affected_by_wall_clock_changes(self):
+        partition = os.path.join(self.tmp_dir, 'sdb1')
+        handler = get_resourcedisk_handler()
+
+        # step the wall clock forward by an hour on every call
+        wall_clock = [time.time()]
+
+        def stepping_time():
+            wall_clock[0] += 3600
+            return wall_clock[0]
+
+        def create_partition(*_):
+            with open(partition, "w"):
+                pass
+
+        with patch.object(handler, "_inotify_watch", return_value=None):
+            with patch("azurelinuxagent.daemon.resourcedisk.default.time.time", side_effect=stepping_time):
+                with patch("azurelinuxagent.daemon.resourcedisk.default.time.sleep", side_effect=create_partition):
+                    self.assertTrue(handler._wait_for_partition(partition, timeout=10))  # pylint: disable=protected-access
 
     def test_change_partition_type(self):
         resource_handler = get_resourcedisk_handler()
         # test when sfdisk --part-type does not exist
-        with patch.object(shellutil, "run_get_output",
-                          side_effect=[[1, ''], [0, '']]) as run_patch:
+        with patch.object(shellutil, "run_command",
+                          side_effect=[CommandError(["sfdisk"], 1, '', 'unrecognized option'), '']) as run_patch:
             resource_handler.change_partition_type(
-                suppress_message=True, option_str='')
+                suppress_message=True, options=['/dev/sdb', '1', '-n'])
 
             # assert
             assert run_patch.call_count == 2
-            assert "sfdisk --part-type" in run_patch.call_args_list[0][0][0]
-            assert "sfdisk -c" in run_patch.call_args_list[1][0][0]
+            self.assertEqual(["sfdisk", "--part-type", "-f", "/dev/sdb", "1", "-n"], run_patch.call_args_list[0][0][0])
+            self.assertEqual(["sfdisk", "-c", "-f", "/dev/sdb", "1", "-n"], run_patch.call_args_list[1][0][0])
 
         # test when sfdisk --part-type exists
-        with patch.object(shellutil, "run_get_output",
-                          side_effect=[[0, '']]) as run_patch:
-            resource_handler.change_partition_type(
-                suppress_message=True, option_str='')
+        with patch.object(shellutil, "run_command",
+                          side_effect=['83\n']) as run_patch:
+            err_code, output = resource_handler.change_partition_type(
+                suppress_message=False, options=['/dev/sdb', '1', '83'])
 
             # assert
             assert run_patch.call_count == 1
-            assert "sfdisk --part-type" in run_patch.call_args_list[0][0][0]
+            self.assertEqual(["sfdisk", "--part-type", "/dev/sdb", "1", "83"], run_patch.call_args_list[0][0][0])
+            self.assertEqual((0, '83\n'), (err_code, output))
 
     def test_check_existing_swap_file(self):
         test_file = os.path.join(self.tmp_dir, 'test_swap_file')
@@ -143,6 +217,24 @@ class TestResourceDisk(AgentTestCase):
 
         os.remove(test_file)
 
+    def test_check_existing_swap_file_should_return_false_when_the_swap_file_does_not_match(self):
+        test_file = os.path.join(self.tmp_dir, 'test_swap_file')
+        file_size = 1024 * 128
+        handler = get_resourcedisk_handler()
+
+        # missing file
+        self.assertFalse(handler.check_existing_swap_file(test_file, test_file, file_size))
+
+        with open(test_file, "wb") as file:  # pylint: disable=redefined-builtin
+            file.write(bytearray(file_size))
+
+        # swap not enabled, wrong size
+        self.assertFalse(handler.check_existing_swap_file(test_file, "", file_size))
+        self.assertFalse(handler.check_existing_swap_file(test_file, test_file, file_size * 2))
+        self.assertTrue(handler.check_existing_swap_file(test_file, test_file, file_size))
+
+        os.remove(test_file)
+
 
 if __name__ == '__main__':
     unittest.main()